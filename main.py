@@ -1,17 +1,24 @@
+import io
 import os
 import re
+import string
+import multiprocessing
+import itertools
+import threading
 import subprocess
 import argparse
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import requests
 import pandas as pd
 import numpy as np
+import h5py
 import librosa
+import soundfile as sf
+import scipy.fft
 from google.cloud import storage
 from youtube_search import YoutubeSearch
-from bs4 import BeautifulSoup
-from pydub import AudioSegment
 from pytubefix import YouTube
 
 # Constants
@@ -19,6 +26,13 @@ from pytubefix import YouTube
 BASE_URL = 'https://dianisa.com/lagu-daerah-indonesia-beserta-lirik-dan-asalnya/'
 MAX_VIDEO_DURATION = 500
 SEGMENT_DURATION = 30
+SEGMENT_SAMPLE_RATE = 22050
+
+MFCC_N_FFT = 2048
+MFCC_HOP_LENGTH = 512
+MFCC_N_MELS = 128
+MFCC_N_COEFFICIENTS = 40
+MFCC_BATCH_SIZE = 8
 
 BUCKET_NAME = os.getenv('BUCKET_NAME')
 STORAGE_TYPE = os.getenv('STORAGE_TYPE')
@@ -27,6 +41,23 @@ SONG_SEARCH_MAX_RESULTS = 15
 SONG_LENGTH_PER_TITLE = 5
 
 DOWNLOAD_SONG_LIMIT = 5
+DOWNLOAD_WORKERS = 8
+SEGMENT_WORKERS = min(4, os.cpu_count() or 1)
+
+class _KeepCharsTable(dict):
+    def __missing__(self, char):
+        self[char] = None
+        return None
+
+UNDERSCORES_PATTERN = re.compile(r'_{2,}')
+TITLE_CHARS_TABLE = _KeepCharsTable({ord(c): c for c in string.ascii_lowercase + string.digits + '_'})
+
+SESSION = requests.Session()
+SESSION.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+print_lock = threading.Lock()
+download_locks = {}
+download_locks_lock = threading.Lock()
 
 
 def main():
@@ -38,27 +69,38 @@ def main():
     
     results_df = pd.DataFrame(download_results)
     results_df.to_csv('data/results.csv', index=False)
-    
-    results_df['wav_path'] = results_df['path'].apply(convert_to_wav)
-    results_df = results_df[results_df['wav_path'].notnull()]
-    results_df.to_csv('data/results_wav.csv', index=False)
+    results_df = results_df[results_df['path'].notnull()]
 
     segments_df = split_songs_to_segments(results_df)
-    segments_df['mfcc'] = segments_df['30s_path'].map(extract_features)
+    segment_paths = segments_df['30s_path'].tolist()
+    batches = [segment_paths[i:i + MFCC_BATCH_SIZE] for i in range(0, len(segment_paths), MFCC_BATCH_SIZE)]
+    with multiprocessing.Pool(os.cpu_count()) as pool:
+        mfccs = list(itertools.chain.from_iterable(pool.map(extract_features, batches)))
+    
+    extracted = [mfcc is not None for mfcc in mfccs]
+    segments_df = segments_df[extracted]
     segments_df.to_csv('data/30s_segments.csv', index=False)
+    save_features('data/features.h5', [mfcc for mfcc in mfccs if mfcc is not None], segments_df['30s_path'])
 
     print('Extracted MFCC features for all 30s segments')
     print('Continue to training...')
 
+@lru_cache(maxsize=None)
+def get_bucket():
+    return storage.Client().bucket(BUCKET_NAME)
+
 def setup_directories(paths):
-    for path in paths:
-        if STORAGE_TYPE == 'gcs':
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(BUCKET_NAME)
-            blob = bucket.blob(path)
-            if not blob.exists():
-                blob.upload_from_string('')
-        else:
+    if STORAGE_TYPE == 'gcs':
+        bucket = get_bucket()
+        existing = set()
+        for parent in {os.path.dirname(path) for path in paths}:
+            prefix = f'{parent}/' if parent else ''
+            existing.update(blob.name for blob in bucket.list_blobs(prefix=prefix, delimiter='/'))
+        for path in paths:
+            if path not in existing:
+                bucket.blob(path).upload_from_string('')
+    else:
+        for path in paths:
             os.makedirs(path, exist_ok=True)
 
 def load_song_data():
@@ -68,29 +110,14 @@ def load_song_data():
         return get_song_list()
 
 def get_song_list():
-    response = requests.get(BASE_URL)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    table = soup.find_all('table', class_='has-fixed-layout')[0]
-
-    rows = table.find_all('tr')
-    data = []
-        
-    for i, row in enumerate(rows):
-        if i == 0:
-            continue
-        cols = row.find_all('td')
-        
-        cols = [ele.text.strip() for ele in cols]
-        data.append([ele for ele in cols if ele])
+    response = SESSION.get(BASE_URL, timeout=10)
+    tables = pd.read_html(io.BytesIO(response.content), attrs={'class': 'has-fixed-layout'}, header=0)
     
-    df = pd.DataFrame(data)
+    df = tables[0]
     df.columns = ['nama_lagu', 'asal']
     
     if STORAGE_TYPE == 'gcs':
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        
-        blob = bucket.blob('data/lagu_daerah.csv')
+        blob = get_bucket().blob('data/lagu_daerah.csv')
         blob.upload_from_string(df.to_csv(index=False))
     else:
         df.to_csv('data/lagu_daerah.csv', index=False)
@@ -102,129 +129,219 @@ def search_youtube(query):
         result['url'] = 'https://www.youtube.com' + result['url_suffix']
     return search_results
 
+@lru_cache(maxsize=4096)
 def yt_title_clean(title):
     text = title.lower().replace(' ', '_')
-    return re.sub(r'[^a-z0-9_]', '', re.sub(r'_{2,}', '_', text))
+    return UNDERSCORES_PATTERN.sub('_', text).translate(TITLE_CHARS_TABLE)
+
+def safe_print(*args):
+    with print_lock:
+        print(*args)
 
 def download_songs(data):
+    rows = list(data.itertuples(index=False))
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        download_results = executor.map(_process_row, rows)
+    return list(itertools.chain.from_iterable(download_results))
+
+def _process_row(row):
+    keyword = f"Lagu Daerah {row.nama_lagu} asal {row.asal}"
+    searched_songs = search_youtube(keyword)
+    
+    durations = parse_durations([song['duration'] for song in searched_songs])
+    
     download_results = []
-    for _, row in data.iterrows():
-        keyword = f"Lagu Daerah {row['nama_lagu']} asal {row['asal']}"
-        searched_songs = search_youtube(keyword)
-        
-        downloaded_count = 0
-        for song in searched_songs:
-            if downloaded_count >= SONG_LENGTH_PER_TITLE:
-                print(f"Downloaded {downloaded_count} songs for {row['nama_lagu']}")
-                break
-            try:
-                duration = parse_duration(song['duration'])
-                if duration < MAX_VIDEO_DURATION:
-                    path = download_video(song['url'])
-
-                    download_results.append({
-                        'title': song['title'],
-                        'nama_lagu': row['nama_lagu'],
-                        'region': row['asal'],
-                        'keyword': f"{row['asal']},{row['asal']}",
-                        'duration': duration,
-                        'url': song['url'],
-                        'path': path
-                    })
-                    
-                    downloaded_count += 1 
-                else:
-                    print(f"Duration of {song['title']} is too long")
-            except ValueError as e:
-                print(f"Error parsing duration for {song['title']}: {e}")
+    downloaded_count = 0
+    for song, duration in zip(searched_songs, durations):
+        if downloaded_count >= SONG_LENGTH_PER_TITLE:
+            safe_print(f"Downloaded {downloaded_count} songs for {row.nama_lagu}")
+            break
+        if np.isnan(duration):
+            safe_print(f"Error parsing duration for {song['title']}: {song['duration']}")
+        elif duration < MAX_VIDEO_DURATION:
+            path = download_video(song['url'])
+
+            download_results.append({
+                'title': song['title'],
+                'nama_lagu': row.nama_lagu,
+                'region': row.asal,
+                'keyword': f"{row.asal},{row.asal}",
+                'duration': int(duration),
+                'url': song['url'],
+                'path': path
+            })
+            
+            downloaded_count += 1 
+        else:
+            safe_print(f"Duration of {song['title']} is too long")
     return download_results
 
-def parse_duration(duration_str):
-    duration_str = duration_str.replace('.', ':')
-    if duration_str.count(':') == 2:
-        duration = datetime.strptime(duration_str, '%H:%M:%S')
-    else:
-        duration = datetime.strptime(duration_str, '%M:%S')
-    return duration.hour * 3600 + duration.minute * 60 + duration.second
+def parse_durations(duration_strs):
+    normalized = []
+    for duration_str in duration_strs:
+        duration_str = str(duration_str).replace('.', ':')
+        normalized.append(duration_str if duration_str.count(':') == 2 else f'0:{duration_str}')
+    return pd.to_timedelta(normalized, errors='coerce').total_seconds().to_numpy()
 
 def download_video(video_id):
     try:
         yt = YouTube(video_id, 'IOS')
-        print(f'Downloading {yt.title}...')
+        safe_print(f'Downloading {yt.title}...')
         
         title = yt_title_clean(yt.title)
         
         file_path = f'datasets/songs/{title}.mp3'
-        if os.path.exists(file_path):
-            print(f'{title} already exists, skipping...')
-            return file_path
-        
-        song = yt.streams.get_audio_only()
+        with download_locks_lock:
+            path_lock = download_locks.setdefault(file_path, threading.Lock())
         
-        song.download(mp3=True, output_path='datasets/songs', filename=title)
+        with path_lock:
+            if os.path.exists(file_path):
+                safe_print(f'{title} already exists, skipping...')
+                return file_path
+            
+            song = yt.streams.get_audio_only()
+            
+            song.download(mp3=True, output_path='datasets/songs', filename=title)
         return file_path
     except Exception as e:
-        print(f'Error: {e}')
+        safe_print(f'Error: {e}')
         return None
 
-def convert_to_wav(path):
-    if not path:
-        print(f'File is not found: {path}')
-        return None
-    wav_path = path.replace('songs', 'wav_songs').replace('.mp3', '.wav')
-    if os.path.exists(wav_path):
-        return wav_path
-    os.makedirs('datasets/wav_songs', exist_ok=True)
-    print(f'Converting {path} to {wav_path}')
-    subprocess.run(['ffmpeg', '-i', path, wav_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return wav_path
+def get_duration(path):
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode == 0:
+        try:
+            return float(result.stdout)
+        except ValueError:
+            pass
+    safe_print(f'Error reading duration of {path}: {result.stderr.strip() or result.stdout.strip()}')
+    return None
 
 def split_songs_to_segments(df, output_base_folder='datasets/30s_segments'):
-    split_result = []
+    jobs = []
+    output_folders = []
+    for row in df.itertuples():
+        output_folder = f'{output_base_folder}/{yt_title_clean(row.nama_lagu)}'
+        output_folders.append(output_folder)
+        source_name = os.path.splitext(os.path.basename(row.path))[0]
+        jobs.append((row.path, f'{output_folder}/segment_{source_name}_%d.wav', row.nama_lagu))
     
-    for index, row in df.iterrows():
-        wav_path = row['wav_path']
-        nama_lagu = row['nama_lagu']
-        
-        setup_directories([f'{output_base_folder}/{yt_title_clean(nama_lagu)}'])
-        
-        audio = AudioSegment.from_wav(wav_path)
-        total_duration = len(audio) / 1000
-        num_segments = int(total_duration // SEGMENT_DURATION)
-        
-        for i in range(num_segments):
-            start_time = i * SEGMENT_DURATION * 1000
-            end_time = (i + 1) * SEGMENT_DURATION * 1000
-            segment = audio[start_time:end_time]
-            
-            segment_file = f'{output_base_folder}/{yt_title_clean(nama_lagu)}/segment_{index}_{i}.wav'
-            segment.export(segment_file, format='wav')
-            
+    setup_directories(list(dict.fromkeys(output_folders)))
+    
+    unique_jobs = {}
+    for job in jobs:
+        unique_jobs.setdefault(job[:2], job)
+    with ThreadPoolExecutor(max_workers=SEGMENT_WORKERS) as executor:
+        segment_paths = dict(zip(unique_jobs, executor.map(lambda job: split_song(*job), unique_jobs.values())))
+    
+    split_result = []
+    seen_segments = set()
+    for path, segment_pattern, nama_lagu in jobs:
+        for segment_path in segment_paths[(path, segment_pattern)]:
+            if segment_path in seen_segments:
+                continue
+            seen_segments.add(segment_path)
             split_result.append({
                 'title': nama_lagu,
-                '30s_path': segment_file
+                '30s_path': segment_path
             })
             
-        print(f"Saved {num_segments} segments for {nama_lagu}")
-            
-    return pd.DataFrame(split_result)
+    return pd.DataFrame(split_result, columns=['title', '30s_path'])
 
-def extract_features(file_path):
-    try:
-        audio, sample_rate = librosa.load(file_path) 
-        mfccs = librosa.feature.mfcc(y=audio, sr=sample_rate, n_mfcc=40)
-        mfccs_processed = np.mean(mfccs.T,axis=0)
-        
-    except Exception as e:
-        print("Error encountered while parsing file: ", file_path)
-        return None 
-     
-    return mfccs_processed
+def split_song(path, segment_pattern, nama_lagu):
+    duration = get_duration(path)
+    if duration is None:
+        return []
+    num_segments = int(duration // SEGMENT_DURATION)
+    segment_paths = [segment_pattern % i for i in range(num_segments)]
+    
+    source_mtime = os.path.getmtime(path)
+    if num_segments > 0 and all(
+        os.path.exists(segment_path)
+        and os.path.getmtime(segment_path) >= source_mtime
+        and sf.info(segment_path).samplerate == SEGMENT_SAMPLE_RATE
+        for segment_path in segment_paths
+    ):
+        safe_print(f'Segments for {nama_lagu} already exist, skipping...')
+        return segment_paths
+    
+    if num_segments > 0:
+        result = subprocess.run([
+            'ffmpeg', '-y', '-i', path, '-t', str(num_segments * SEGMENT_DURATION),
+            '-f', 'segment', '-segment_time', str(SEGMENT_DURATION), '-c:a', 'pcm_s16le',
+            '-ar', str(SEGMENT_SAMPLE_RATE), segment_pattern
+        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            safe_print(f'Error splitting {path}: {result.stderr.decode(errors="replace").strip()}')
+            return []
+    
+    safe_print(f"Saved {num_segments} segments for {nama_lagu}")
+    return segment_paths
+
+def extract_features(file_paths):
+    return extract_mfcc_features_batch(file_paths, n_mfcc=MFCC_N_COEFFICIENTS)
 
 def extract_mfcc_features(wav_path, n_mfcc=13):
-    y, sr = librosa.load(wav_path)
-    mfccs = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=n_mfcc)
-    return np.mean(mfccs, axis=1)
+    return extract_mfcc_features_batch([wav_path], n_mfcc=n_mfcc)[0]
+
+def extract_mfcc_features_batch(wav_paths, n_mfcc=13):
+    features = [None] * len(wav_paths)
+    batches = {}
+    for i, wav_path in enumerate(wav_paths):
+        cache_path = f'{wav_path}.mfcc{n_mfcc}.npy'
+        try:
+            if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(wav_path):
+                features[i] = np.load(cache_path)
+                continue
+            
+            y, sr = sf.read(wav_path, dtype='float32')
+        except Exception as e:
+            print("Error encountered while parsing file: ", wav_path)
+            continue
+        if y.ndim > 1:
+            y = y.mean(axis=1)
+        batches.setdefault((sr, len(y)), []).append((i, y))
+    
+    for (sr, _), batch in batches.items():
+        indices, signals = zip(*batch)
+        try:
+            mfccs = compute_mfcc(np.stack(signals), sr, n_mfcc)
+            mfccs_processed = np.empty(mfccs.shape[:-1], dtype=np.float32)
+            np.mean(mfccs, axis=-1, out=mfccs_processed)
+            for i, mfcc in zip(indices, mfccs_processed):
+                np.save(f'{wav_paths[i]}.mfcc{n_mfcc}.npy', mfcc)
+        except Exception as e:
+            print("Error encountered while parsing files: ", [wav_paths[i] for i in indices])
+            continue
+        for i, mfcc in zip(indices, mfccs_processed):
+            features[i] = mfcc
+    return features
+
+def save_features(path, mfccs, segment_paths):
+    if mfccs:
+        features = np.stack(mfccs, axis=0).astype(np.float32, copy=False)
+    else:
+        features = np.empty((0, MFCC_N_COEFFICIENTS), dtype=np.float32)
+    
+    with h5py.File(path, 'w') as h:
+        h.create_dataset('mfcc', data=features)
+        h.create_dataset('paths', data=np.array(segment_paths, dtype='S'))
+
+@lru_cache(maxsize=None)
+def mfcc_basis(sr, n_mfcc):
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=MFCC_N_FFT, n_mels=MFCC_N_MELS)
+    dct_basis = scipy.fft.dct(np.eye(MFCC_N_MELS, dtype=np.float32), type=2, norm='ortho', axis=0)[:n_mfcc]
+    return mel_basis, dct_basis
+
+def compute_mfcc(y, sr, n_mfcc):
+    mel_basis, dct_basis = mfcc_basis(sr, n_mfcc)
+    power = np.abs(librosa.stft(y, n_fft=MFCC_N_FFT, hop_length=MFCC_HOP_LENGTH)) ** 2
+    log_mel = 10.0 * np.log10(np.maximum(mel_basis @ power, 1e-10))
+    log_mel = np.maximum(log_mel, log_mel.max(axis=(-2, -1), keepdims=True) - 80.0)
+    return dct_basis @ log_mel
 
 if __name__ == '__main__':
     main()
\ No newline at end of file